@@ -0,0 +1,20 @@
+-- Database setup for the batched API usage counter in main.py (flush_api_usage).
+-- Run once in the Supabase SQL editor after creating the api_keys and api_usage tables.
+
+-- One row per user per day. If api_usage already has duplicate (user_id, date)
+-- rows, merge them into one before adding the constraint.
+alter table api_usage
+  add constraint api_usage_user_id_date_key unique (user_id, date);
+
+-- Adds each {"user_id", "date", "count"} entry to that user's row for the day,
+-- creating the row if needed, in a single statement.
+create or replace function increment_api_usage(deltas jsonb)
+returns void
+language sql
+as $$
+  insert into api_usage (user_id, date, count)
+  select d.user_id, d.date, d.count
+  from jsonb_populate_recordset(null::api_usage, deltas) as d
+  on conflict (user_id, date)
+  do update set count = api_usage.count + excluded.count;
+$$;
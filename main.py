@@ -1,28 +1,70 @@
-import json
+import orjson
 import asyncio
+import gzip
+import math
 import os
+import tempfile
 from fastapi import FastAPI, HTTPException, Depends, Request, Security, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import APIKeyHeader
-from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+from types import MappingProxyType
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 import httpx
 import logging
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from functools import lru_cache, wraps
+from operator import itemgetter
 from supabase import create_client, Client
-from datetime import datetime, timedelta, time
+from datetime import datetime
 from dotenv import load_dotenv
-from fastapi.encoders import jsonable_encoder
 from postgrest.exceptions import APIError
 import postgrest
+from postgrest import AsyncPostgrestClient
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from time import monotonic, time
 
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+UPSTREAM_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "application/json",
+    "Referer": "https://openai.com/",
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The upstream URL map only changes with a deploy, so it's read once here,
+    # as (bot_type, url) pairs in the order update_ips gathers them
+    app.state.bot_urls = tuple(load_url_data().get("openai", {}).items())
+    # One pooled HTTP/2 client for all upstream fetches, so connections survive between updates
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        headers=UPSTREAM_HEADERS,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=60),
+        timeout=10.0,
+    )
+    usage_flusher = asyncio.create_task(usage_flush_loop())
+    # Only one /update-ips run at a time
+    app.state.update_lock = asyncio.Lock()
+    try:
+        yield
+    finally:
+        usage_flusher.cancel()
+        try:
+            await usage_flusher
+        except asyncio.CancelledError:
+            pass
+        await flush_api_usage()
+        await app.state.http.aclose()
+        await supabase_async.aclose()
+
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None, default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Supabase client setup
 supabase_url = os.getenv("SUPABASE_URL")
@@ -32,6 +74,11 @@ if not supabase_url or not supabase_key:
     raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in the .env file")
 
 supabase: Client = create_client(supabase_url, supabase_key)
+# Async PostgREST client for request handlers, so database calls don't block the event loop
+supabase_async = AsyncPostgrestClient(
+    f"{supabase_url}/rest/v1",
+    headers={"apikey": supabase_key, "Authorization": f"Bearer {supabase_key}"},
+)
 
 # Rate limiting
 def get_user_id_for_limit(request: Request):
@@ -50,37 +97,95 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compression
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=6)
+
 # API Key authentication
 API_KEY_NAME = "X-API-Key"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+# In-flight lookups by key, so concurrent cache misses share one fetch
+_inflight: Dict[str, asyncio.Future] = {}
+
+class FlightAbandoned(Exception):
+    # Set on a shared fetch whose caller was cancelled before it finished
+    pass
+
+async def single_flight(key: str, fetch):
+    while key in _inflight:
+        try:
+            return await asyncio.shield(_inflight[key])
+        except FlightAbandoned:
+            # The caller running the fetch went away; the first waiter back takes it over
+            continue
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        result = await fetch()
+    except Exception as exc:
+        future.set_exception(exc)
+        future.exception()  # Mark retrieved in case nobody else was waiting
+        raise
+    except BaseException:
+        future.set_exception(FlightAbandoned())
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        del _inflight[key]
+
+# Daily request limits by tier; any other tier is unlimited
+TIER_LIMITS = MappingProxyType({"free": 10, "basic": 100})
+
+# Verified keys, api_key -> (expires_at, {"tier", "user_id", "limit"}), least recently used first
+KEY_CACHE_TTL = 60
+KEY_CACHE_SIZE = 1024
+_key_cache: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
 async def verify_api_key(api_key: str = Security(api_key_header)):
-    logger.info(f"Verifying API key: {api_key}")
+    logger.debug("Verifying API key: %s", api_key)
     if not api_key:
         logger.warning("No API key provided")
         raise HTTPException(status_code=403, detail="API Key is required")
     
+    cached = _key_cache.get(api_key)
+    if cached is not None:
+        if cached[0] > monotonic():
+            _key_cache.move_to_end(api_key)
+            return {"api_key": api_key, **cached[1]}
+        del _key_cache[api_key]
+
     # Query Supabase for the API key
-    logger.info(f"Querying Supabase for API key: {api_key}")
-    result = supabase.table("api_keys").select("*").eq("api_key", api_key).eq("is_active", True).execute()
+    logger.debug("Querying Supabase for API key: %s", api_key)
+    result = await single_flight(
+        f"api_key:{api_key}",
+        supabase_async.from_("api_keys").select("*").eq("api_key", api_key).eq("is_active", True).execute,
+    )
     
-    logger.info(f"Supabase query result: {result}")
+    logger.debug("Supabase query result: %s", result)
     
     if not result.data:
-        logger.warning(f"Invalid or inactive API key: {api_key}")
+        logger.warning("Invalid or inactive API key: %s", api_key)
         raise HTTPException(status_code=403, detail="Invalid or inactive API Key")
     
     api_key_data = result.data[0]
-    logger.info(f"API key data: {api_key_data}")
-    return {
-        "api_key": api_key,
+    logger.debug("API key data: %s", api_key_data)
+    key_info = {
         "tier": api_key_data['tier'],
-        "user_id": api_key_data['user_id']
+        "user_id": api_key_data['user_id'],
+        "limit": TIER_LIMITS.get(api_key_data['tier'].lower(), math.inf),
     }
+    _key_cache[api_key] = (monotonic() + KEY_CACHE_TTL, key_info)
+    if len(_key_cache) > KEY_CACHE_SIZE:
+        _key_cache.popitem(last=False)
+    return {"api_key": api_key, **key_info}
 
 def format_time_until_reset(seconds):
     hours, remainder = divmod(int(seconds), 3600)
@@ -96,19 +201,18 @@ def tier_limit():
     def decorator(func):
         @wraps(func)
         async def wrapper(api_key_data: dict = Depends(verify_api_key), *args, **kwargs):
-            logger.info(f"In tier_limit wrapper. API key data: {api_key_data}")
+            logger.debug("In tier_limit wrapper. API key data: %s", api_key_data)
             user_id = api_key_data['user_id']
             tier = api_key_data['tier']
             
-            logger.info(f"Checking API usage for user_id: {user_id}, tier: {tier}")
-            allowed, reset_time = await check_and_update_api_usage(user_id, tier)
+            logger.debug("Checking API usage for user_id: %s, tier: %s", user_id, tier)
+            allowed, reset_ts = await check_and_update_api_usage(user_id, api_key_data['limit'])
             if allowed:
-                logger.info(f"API usage check passed for user_id: {user_id}")
+                logger.debug("API usage check passed for user_id: %s", user_id)
                 return await func(api_key_data=api_key_data, *args, **kwargs)
             else:
-                logger.warning(f"API call limit exceeded for user_id: {user_id}")
-                time_until_reset = reset_time - datetime.utcnow()
-                formatted_time = format_time_until_reset(time_until_reset.total_seconds())
+                logger.warning("API call limit exceeded for user_id: %s", user_id)
+                formatted_time = format_time_until_reset(reset_ts - time())
                 raise HTTPException(
                     status_code=429, 
                     detail=f"API call limit exceeded. Resets in {formatted_time}."
@@ -126,62 +230,148 @@ async def protected_route(api_key_data: dict = Depends(verify_api_key)):
 DATA_FILE = "block_ips.json"
 URL_FILE = "ai_urls.json"
 
-class IPData(BaseModel):
-    openai: Dict[str, List[str]]
-
-    class Config:
-        schema_extra = {
-            "example": {
-                "openai": {
-                    "searchbot": ["192.168.1.1/24"],
-                    "chatgpt-user": ["10.0.0.1/24"],
-                    "gptbot": ["172.16.0.1/24"]
-                }
-            }
-        }
-
-def read_ip_data() -> Dict:
+# orjson options: the data file stays human-readable, response bodies are compact
+FILE_DUMP_OPTS = orjson.OPT_INDENT_2
+RESPONSE_DUMP_OPTS = 0
+
+# Parsed file contents, keyed on the mtime they were read at
+_IP_CACHE: Optional[Dict] = None
+_IP_MTIME: float = 0.0
+# Serialized /block-ips and /block-ips/{bot_type} bodies, as (plain, gzipped),
+# rebuilt whenever the IP data changes
+_ip_response_bytes: Tuple[bytes, bytes] = (b"", b"")
+_bot_response_bytes: Dict[str, Tuple[bytes, bytes]] = {}
+
+def set_ip_cache(data: Dict, mtime: float, bodies: Tuple):
+    global _IP_CACHE, _IP_MTIME, _ip_response_bytes, _bot_response_bytes
+    _IP_CACHE, _IP_MTIME = data, mtime
+    _ip_response_bytes, _bot_response_bytes = bodies
+
+def encode_body(payload: Dict) -> Tuple[bytes, bytes]:
+    body = orjson.dumps(payload, option=RESPONSE_DUMP_OPTS)
+    return body, gzip.compress(body, compresslevel=9, mtime=0)
+
+def encode_ip_bodies(data: Dict) -> Tuple[Tuple[bytes, bytes], Dict[str, Tuple[bytes, bytes]]]:
+    return (
+        encode_body({"openai": data["openai"]}),
+        {bot_type: encode_body({bot_type: ips}) for bot_type, ips in data["openai"].items()},
+    )
+
+DEFAULT_IP_DATA = {"openai": {"searchbot": [], "chatgpt-user": [], "gptbot": []}}
+DEFAULT_IP_BODIES = encode_ip_bodies(DEFAULT_IP_DATA)
+
+@lru_cache(maxsize=64)
+def accepts_gzip(accept_encoding: str) -> bool:
+    # An explicit gzip entry wins over "*"; q=0 means the coding is refused
+    qualities = {}
+    for token in accept_encoding.split(","):
+        coding, _, params = token.partition(";")
+        coding = coding.strip().lower()
+        if coding not in ("gzip", "*"):
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+def body_response(request: Request, body: Tuple[bytes, bytes]) -> Response:
+    # Bodies are compressed once up front, so GZipMiddleware leaves these alone
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        return Response(
+            content=body[1],
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return Response(content=body[0], media_type="application/json", headers={"Vary": "Accept-Encoding"})
+
+# Blocking file I/O, run in a worker thread by the async helpers below
+def read_json_file(path: str) -> Dict:
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+def write_json_file(path: str, data: Dict) -> float:
+    # Write a temp file next to the target and swap it in, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data, option=FILE_DUMP_OPTS))
+        # mkstemp creates the file as 0600; keep the existing file's permissions
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return os.stat(path).st_mtime
+
+def load_ip_file() -> Tuple[Dict, float, Tuple]:
+    mtime = os.stat(DATA_FILE).st_mtime
+    data = read_json_file(DATA_FILE)
+    return data, mtime, encode_ip_bodies(data)
+
+def save_ip_file(data: Dict) -> Tuple[float, Tuple]:
+    return write_json_file(DATA_FILE, data), encode_ip_bodies(data)
+
+async def load_ip_data() -> Dict:
+    # Reads, parses and serializes the response bodies once for all waiting callers
+    try:
+        data, mtime, bodies = await asyncio.to_thread(load_ip_file)
+        logger.debug("Read IP data: %s", data)
+    except FileNotFoundError:
+        logger.warning("File %s not found. Returning default data.", DATA_FILE)
+        data, mtime, bodies = DEFAULT_IP_DATA, 0.0, DEFAULT_IP_BODIES
+        _upstream_etags.clear()
+    except orjson.JSONDecodeError:
+        logger.error("Error decoding JSON from %s. Returning default data.", DATA_FILE)
+        data, mtime, bodies = DEFAULT_IP_DATA, 0.0, DEFAULT_IP_BODIES
+        # The stored ETags describe lists that are no longer served, so force a full refetch
+        _upstream_etags.clear()
+    set_ip_cache(data, mtime, bodies)
+    return data
+
+async def read_ip_data() -> Dict:
     try:
-        with open(DATA_FILE, "r") as f:
-            data = json.load(f)
-            logger.info(f"Read IP data: {data}")
-            return data
+        if _IP_CACHE is not None and os.stat(DATA_FILE).st_mtime == _IP_MTIME:
+            return _IP_CACHE
     except FileNotFoundError:
-        logger.warning(f"File {DATA_FILE} not found. Returning default data.")
-        return {"openai": {"searchbot": [], "chatgpt-user": [], "gptbot": []}}
-    except json.JSONDecodeError:
-        logger.error(f"Error decoding JSON from {DATA_FILE}. Returning default data.")
-        return {"openai": {"searchbot": [], "chatgpt-user": [], "gptbot": []}}
+        pass
+    return await single_flight(DATA_FILE, load_ip_data)
 
-def write_ip_data(data: Dict):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+async def write_ip_data(data: Dict):
+    mtime, bodies = await asyncio.to_thread(save_ip_file, data)
+    set_ip_cache(data, mtime, bodies)
 
 @app.get("/block-ips")
 @tier_limit()
-async def get_block_ips(api_key_data: dict = Depends(verify_api_key)):
-    logger.info(f"get_block_ips called with api_key_data: {api_key_data}")
+async def get_block_ips(request: Request, api_key_data: dict = Depends(verify_api_key)):
+    logger.debug("get_block_ips called with api_key_data: %s", api_key_data)
     try:
-        data = read_ip_data()
-        logger.info(f"IP data read: {data}")
-        return jsonable_encoder(IPData(openai=data["openai"]))
+        await read_ip_data()
+        return body_response(request, _ip_response_bytes)
     except Exception as e:
-        logger.error(f"Error in get_block_ips: {str(e)}")
+        logger.error("Error in get_block_ips: %s", e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-@app.get("/block-ips/{bot_type}", response_model=Dict[str, List[str]])
+@app.get("/block-ips/{bot_type}")
 @tier_limit()
-@lru_cache(maxsize=32)
-async def get_bot_ips(bot_type: str, api_key_data: dict = Depends(verify_api_key)):
-    data = read_ip_data()
-    if bot_type in data["openai"]:
-        return {bot_type: data["openai"][bot_type]}
+async def get_bot_ips(bot_type: str, request: Request, api_key_data: dict = Depends(verify_api_key)):
+    await read_ip_data()
+    body = _bot_response_bytes.get(bot_type)
+    if body is not None:
+        return body_response(request, body)
     raise HTTPException(status_code=404, detail="Bot type not found")
 
-def read_url_data() -> Dict:
+def load_url_data() -> Dict:
     try:
-        with open(URL_FILE, "r") as f:
-            return json.load(f)
+        return orjson.loads(Path(URL_FILE).read_bytes())
     except FileNotFoundError:
         return {"openai": {}}
 
@@ -189,109 +379,262 @@ UPDATE_IP_PASS = os.getenv("UPDATE_IP_PASS")
 if not UPDATE_IP_PASS:
     raise ValueError("UPDATE_IP_PASS must be set in the .env file")
 
+# ETag of the last upstream response applied for each bot type
+_upstream_etags: Dict[str, str] = {}
+get_prefix = itemgetter('ipv4Prefix')
+
+def parse_bodies(bodies: List[bytes]) -> List:
+    results = []
+    for body in bodies:
+        try:
+            results.append(orjson.loads(body))
+        except orjson.JSONDecodeError as exc:
+            results.append(exc)
+    return results
+
 @app.get("/update-ips")
-async def update_ips(x_update_key: str = Header(...)):
+async def update_ips(request: Request, x_update_key: str = Header(...)):
     if x_update_key != UPDATE_IP_PASS:
         raise HTTPException(status_code=403, detail="Invalid update key")
     
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Accept": "application/json",
-        "Referer": "https://openai.com/",
-    }
-    url_data = read_url_data()
-    openai_urls = url_data.get("openai", {})
-    errors = []
-
-    logger.info("Starting IP update process")
-    current_data = read_ip_data()
-    updated = False
-
-    async with httpx.AsyncClient(headers=headers) as client:
+    async with request.app.state.update_lock:
+        bot_urls = request.app.state.bot_urls
+        errors = []
+
+        logger.info("Starting IP update process")
+        # Copy so the cached data isn't modified before it's written back
+        current_data = {"openai": dict((await read_ip_data())["openai"])}
+        updated = False
+        unchanged = []
+        # Only remembered once the new lists are written, so a failed write is retried in full next time
+        new_etags = {}
+
+        client = request.app.state.http
         await client.get("https://openai.com/")
-        
-        for bot_type, url in openai_urls.items():
-            logger.info(f"Fetching data for {bot_type} from {url}")
+
+        logger.info("Fetching data for %s", ", ".join(bot_type for bot_type, _ in bot_urls))
+        # An ETag only counts while the served data still holds that bot's list
+        known_etags = {bot_type: etag for bot_type, etag in _upstream_etags.items() if current_data["openai"].get(bot_type)}
+        tasks = [
+            client.get(url, timeout=10.0, headers={"If-None-Match": known_etags[bot_type]} if bot_type in known_etags else None)
+            for bot_type, url in bot_urls
+        ]
+        responses = await asyncio.gather(*tasks, return_exceptions=True)
+
+        fetched = []
+        for (bot_type, _), response in zip(bot_urls, responses):
             try:
-                await asyncio.sleep(1)  # 1 second delay between requests
-                response = await client.get(url, timeout=10.0)
+                if isinstance(response, Exception):
+                    raise response
+                etag = response.headers.get("ETag")
+                if bot_type in known_etags and (response.status_code == 304 or etag == known_etags[bot_type]):
+                    logger.info("IP data unchanged for %s", bot_type)
+                    unchanged.append(bot_type)
+                    continue
                 response.raise_for_status()
-                logger.info(f"Response content for {bot_type}: {response.text}")
-                data = response.json()
-                logger.info(f"Parsed JSON for {bot_type}: {data}")
-                ip_list = [prefix['ipv4Prefix'] for prefix in data.get('prefixes', [])]
+                fetched.append((bot_type, response))
+            except httpx.HTTPStatusError as exc:
+                logger.warning("HTTP error occurred for %s: %s", bot_type, exc)
+                errors.append(f"HTTP error occurred for {bot_type}: {exc}")
+            except Exception as exc:
+                logger.error("Unexpected error occurred for %s: %s", bot_type, exc)
+                errors.append(f"Unexpected error occurred for {bot_type}: {exc}")
+
+        # Parse all bodies in one worker thread to keep the event loop free
+        parsed = await asyncio.to_thread(parse_bodies, [response.content for _, response in fetched])
+
+        for (bot_type, response), data in zip(fetched, parsed):
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                logger.debug("Parsed JSON for %s: %s", bot_type, data)
+                # Entries without an IPv4 prefix (e.g. IPv6-only) are skipped
+                ip_list = list(map(get_prefix, (prefix for prefix in data.get('prefixes', ()) if 'ipv4Prefix' in prefix)))
                 if ip_list:
                     current_data["openai"][bot_type] = ip_list
                     updated = True
-                    logger.info(f"Successfully updated data for {bot_type}: {ip_list}")
+                    if "ETag" in response.headers:
+                        new_etags[bot_type] = response.headers["ETag"]
+                    logger.info("Successfully updated data for %s (%d prefixes)", bot_type, len(ip_list))
+                    logger.debug("New IP data for %s: %s", bot_type, ip_list)
                 else:
-                    logger.warning(f"No IP data found for {bot_type}")
+                    logger.warning("No IP data found for %s", bot_type)
                     errors.append(f"No IP data found for {bot_type}")
-            except httpx.HTTPStatusError as exc:
-                logger.warning(f"HTTP error occurred for {bot_type}: {exc}")
-                errors.append(f"HTTP error occurred for {bot_type}: {exc}")
-            except json.JSONDecodeError as exc:
-                logger.error(f"JSON decode error for {bot_type}: {exc}")
+            except orjson.JSONDecodeError as exc:
+                logger.error("JSON decode error for %s: %s", bot_type, exc)
                 errors.append(f"JSON decode error for {bot_type}: {exc}")
             except Exception as exc:
-                logger.error(f"Unexpected error occurred for {bot_type}: {exc}")
+                logger.error("Unexpected error occurred for %s: %s", bot_type, exc)
                 errors.append(f"Unexpected error occurred for {bot_type}: {exc}")
 
-    if updated:
-        write_ip_data(current_data)
-        logger.info("IP data update completed with partial success")
-        return {
-            "message": "IP data update completed with partial success",
-            "data": current_data["openai"],
-            "warnings": errors if errors else None
-        }
-    else:
-        error_message = "Failed to retrieve any valid IP data. "
-        if errors:
-            error_message += f"\n\nErrors encountered: {'; '.join(errors)}"
-        logger.error(error_message)
-        raise HTTPException(status_code=503, detail=error_message)
+        if updated:
+            await write_ip_data(current_data)
+            _upstream_etags.update(new_etags)
+            logger.info("IP data update completed with partial success")
+            return {
+                "message": "IP data update completed with partial success",
+                "data": current_data["openai"],
+                "warnings": errors if errors else None
+            }
+        elif unchanged:
+            logger.info("IP data is already up to date")
+            return {
+                "message": "IP data is already up to date",
+                "data": current_data["openai"],
+                "warnings": errors if errors else None
+            }
+        else:
+            error_message = "Failed to retrieve any valid IP data. "
+            if errors:
+                error_message += f"\n\nErrors encountered: {'; '.join(errors)}"
+            logger.error(error_message)
+            raise HTTPException(status_code=503, detail=error_message)
+
+HEALTH_BODY = orjson.dumps({"status": "healthy"}, option=RESPONSE_DUMP_OPTS)
 
 @app.get("/health")
 async def health_check():
-    return JSONResponse(content={"status": "healthy"}, status_code=200)
-
-# Add the check_and_update_api_usage function
-async def check_and_update_api_usage(user_id: str, tier: str):
-    now = datetime.utcnow()
-    today = now.date()
-    reset_time = datetime.combine(today, time(hour=0, minute=0)) + timedelta(days=1)
+    return Response(content=HEALTH_BODY, media_type="application/json", status_code=200)
+
+# API usage is counted in memory and flushed to Supabase in batches.
+# Counts are keyed on (user_id, date) and re-read from the database once stale.
+USAGE_FRESH_SECONDS = 30
+USAGE_FLUSH_INTERVAL = 1.0
+# Repeated flush failures back off up to this many seconds and are logged as critical
+USAGE_FLUSH_MAX_BACKOFF = 60.0
+USAGE_FLUSH_ALERT_AFTER = 10
+_usage_flush_failures = 0
+_usage_cached: Dict[Tuple[str, str], int] = {}
+_usage_seeded_at: Dict[Tuple[str, str], float] = {}
+_usage_delta: Dict[Tuple[str, str], int] = {}
+_usage_inflight: Dict[Tuple[str, str], int] = {}
+# Bumped whenever a flush starts or ends, to detect a reseed that overlapped one
+_usage_flush_seq = 0
+
+async def get_usage_count(user_id: str, date: str) -> int:
+    key = (user_id, date)
+    seeded_at = _usage_seeded_at.get(key)
+    if seeded_at is not None and monotonic() - seeded_at < USAGE_FRESH_SECONDS:
+        return _usage_cached[key]
+    # A flush for this key could commit at any point during a reseed, so keep the local count for now
+    if key in _usage_inflight and key in _usage_cached:
+        return _usage_cached[key]
+
+    flush_seq = _usage_flush_seq
+    result = await single_flight(
+        f"api_usage:{user_id}:{date}",
+        supabase_async.from_("api_usage").select("count").eq("user_id", user_id).eq("date", date).execute,
+    )
+    # Same if a flush started or finished while the SELECT ran: the row may or may not include it
+    if flush_seq != _usage_flush_seq and key in _usage_cached:
+        return _usage_cached[key]
+    stored = result.data[0]['count'] if result.data else 0
+    # Increments not yet committed to the database still count
+    count = stored + _usage_delta.get(key, 0) + _usage_inflight.get(key, 0)
+    _usage_cached[key] = count
+    _usage_seeded_at[key] = monotonic()
+    return count
+
+async def flush_api_usage():
+    global _usage_flush_failures, _usage_flush_seq
+    if not _usage_delta:
+        return
+    _usage_flush_seq += 1
+    batch = dict(_usage_delta)
+    _usage_delta.clear()
+    for key, delta in batch.items():
+        _usage_inflight[key] = _usage_inflight.get(key, 0) + delta
+
+    flushed = False
+    try:
+        # increment_api_usage (see api_usage.sql) adds each delta to the user's row for the day
+        await supabase_async.rpc("increment_api_usage", {
+            "deltas": [{"user_id": user_id, "date": date, "count": delta} for (user_id, date), delta in batch.items()]
+        }).execute()
+        flushed = True
+        _usage_flush_failures = 0
+    except Exception as e:
+        _usage_flush_failures += 1
+        logger.error("Error flushing API usage (attempt %d): %s", _usage_flush_failures, e)
+        if _usage_flush_failures == USAGE_FLUSH_ALERT_AFTER:
+            logger.critical(
+                "API usage has not been saved for %d attempts; check that increment_api_usage "
+                "from api_usage.sql exists in the database", _usage_flush_failures
+            )
+    finally:
+        # Put the batch back on any failure, including cancellation mid-request
+        if not flushed:
+            # While flushes keep failing, only today's counts are kept, so pending keys stay bounded
+            today = current_day(time())[0] if _usage_flush_failures >= USAGE_FLUSH_ALERT_AFTER else None
+            dropped = 0
+            for key, delta in batch.items():
+                if today is not None and key[1] != today:
+                    dropped += delta
+                    continue
+                _usage_delta[key] = _usage_delta.get(key, 0) + delta
+            if dropped:
+                logger.warning("Dropped %d unsaved API usage increments from previous days", dropped)
+        for key, delta in batch.items():
+            _usage_inflight[key] -= delta
+            if not _usage_inflight[key]:
+                del _usage_inflight[key]
+        _usage_flush_seq += 1
+
+async def usage_flush_loop():
+    while True:
+        await asyncio.sleep(min(USAGE_FLUSH_INTERVAL * 2 ** min(_usage_flush_failures, 6), USAGE_FLUSH_MAX_BACKOFF))
+        await flush_api_usage()
+
+        # Forget stale counts with nothing pending so old dates don't pile up
+        now = monotonic()
+        for key in [k for k, t in _usage_seeded_at.items() if now - t >= USAGE_FRESH_SECONDS]:
+            if key not in _usage_delta and key not in _usage_inflight:
+                del _usage_seeded_at[key]
+                del _usage_cached[key]
+
+# Today's UTC date and next midnight reset, recomputed only when the day rolls over:
+# (epoch_day, date string, reset as epoch seconds, reset as ISO string)
+_day_cache: Tuple[int, str, int, str] = (-1, "", 0, "")
+
+def current_day(now_ts: float) -> Tuple[str, int, str]:
+    global _day_cache
+    day = int(now_ts // 86400)
+    if day != _day_cache[0]:
+        reset_ts = (day + 1) * 86400
+        _day_cache = (
+            day,
+            datetime.utcfromtimestamp(day * 86400).date().isoformat(),
+            reset_ts,
+            datetime.utcfromtimestamp(reset_ts).isoformat(),
+        )
+    return _day_cache[1], _day_cache[2], _day_cache[3]
+
+async def check_and_update_api_usage(user_id: str, limit: float):
+    today, reset_ts, _ = current_day(time())
     
     try:
-        result = supabase.table("api_usage").select("*").eq("user_id", user_id).eq("date", str(today)).execute()
-        
-        if not result.data:
-            supabase.table("api_usage").insert({"user_id": user_id, "date": str(today), "count": 1}).execute()
-            return True, reset_time
-        
-        usage = result.data[0]
-        new_count = usage['count'] + 1
-        
-        limit = 10 if tier.lower() == "free" else 100 if tier.lower() == "basic" else float('inf')
+        key = (user_id, today)
+        new_count = await get_usage_count(*key) + 1
         
         if new_count > limit:
-            return False, reset_time
+            return False, reset_ts
         
-        supabase.table("api_usage").update({"count": new_count}).eq("id", usage['id']).execute()
-        return True, reset_time
+        _usage_cached[key] = new_count
+        _usage_delta[key] = _usage_delta.get(key, 0) + 1
+        return True, reset_ts
     except Exception as e:
-        logger.error(f"Error in check_and_update_api_usage: {str(e)}")
-        return True, reset_time
+        logger.error("Error in check_and_update_api_usage: %s", e)
+        return True, reset_ts
 
 def ensure_tables_exist():
     try:
         # Check if the api_keys table exists
         api_keys_result = supabase.table("api_keys").select("id").limit(1).execute()
-        logger.info(f"api_keys table exists. Result: {api_keys_result}")
+        logger.info("api_keys table exists. Result: %s", api_keys_result)
 
         # Check if the api_usage table exists
         api_usage_result = supabase.table("api_usage").select("id").limit(1).execute()
-        logger.info(f"api_usage table exists. Result: {api_usage_result}")
+        logger.info("api_usage table exists. Result: %s", api_usage_result)
     except APIError as e:
         if 'relation "public.api_keys" does not exist' in str(e):
             logger.error("api_keys table does not exist. Please create it manually in your Supabase database.")
@@ -300,7 +643,7 @@ def ensure_tables_exist():
             logger.error("api_usage table does not exist. Please create it manually in your Supabase database.")
             raise ValueError("api_usage table does not exist in the database")
         else:
-            logger.error(f"Unexpected error when checking tables: {str(e)}")
+            logger.error("Unexpected error when checking tables: %s", e)
             raise e
 
 @app.get("/api-usage")
@@ -309,30 +652,31 @@ async def get_api_usage(api_key_data: dict = Depends(verify_api_key)):
     user_id = api_key_data['user_id']
     tier = api_key_data['tier']
     
-    now = datetime.utcnow()
-    today = now.date()
-    reset_time = datetime.combine(today, time(hour=0, minute=0)) + timedelta(days=1)
+    now_ts = time()
+    today, reset_ts, reset_iso = current_day(now_ts)
     
-    result = supabase.table("api_usage").select("*").eq("user_id", user_id).eq("date", str(today)).execute()
-    
-    if not result.data:
-        used_requests = 0
-    else:
-        used_requests = result.data[0]['count']
+    used_requests = await get_usage_count(user_id, today)
     
-    limit = 10 if tier.lower() == "free" else 100 if tier.lower() == "basic" else float('inf')
-    remaining_requests = max(0, limit - used_requests)
-    time_until_reset = reset_time - now
+    remaining_requests = max(0, api_key_data['limit'] - used_requests)
     
     return {
         "tier": tier,
         "used_requests": used_requests,
         "remaining_requests": remaining_requests,
-        "reset_in_seconds": time_until_reset.total_seconds(),
-        "reset_time": reset_time.isoformat()
+        "reset_in_seconds": reset_ts - now_ts,
+        "reset_time": reset_iso
     }
 
 if __name__ == "__main__":
     ensure_tables_exist()
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
\ No newline at end of file
+    # Pass the app object so uvicorn serves this module rather than re-importing it.
+    # Keep a single worker: usage counts, the /update-ips lock and the IP data
+    # cache are per process and aren't safe to share across workers yet.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+    )
\ No newline at end of file